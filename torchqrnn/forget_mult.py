@@ -1,10 +1,17 @@
 import math
+import numpy as np
 import torch
 from torch.autograd import Variable
 from cupy.cuda import function
 from pynvrtc.compiler import Program
 from collections import namedtuple
 
+# Numba is optional and only used to speed up the CPU recurrence when no gradients are required
+try:
+    import numba
+except ImportError:
+    numba = None
+
 ###
 
 kernel = '''
@@ -67,20 +74,101 @@ __global__ void bwd_recurrent_forget_mult(const float *h, const float *f, const
   }
   ghinit[bid * HIDDEN + hid] = running_f;
 }
+
+extern "C"
+__global__ void recurrent_forget_mult_reverse(float *dst, const float *f, const float *x, int SEQ, int BATCH, int HIDDEN)
+{
+  /*
+  Note: destination is assumed to be one timestep longer than f or x where dst[SEQ] = h_{SEQ}
+  Walking backwards in time means dst shares the index of f or x and h_{t+1} sits one timestep later
+  */
+  int hid = blockIdx.x * blockDim.x + threadIdx.x;
+  int bid = blockIdx.y * blockDim.y + threadIdx.y;
+  if(hid >= HIDDEN || bid >= BATCH)
+     return;
+  //
+  for (int ts = SEQ - 1; ts >= 0; ts--) {
+     int i           = ts * HIDDEN * BATCH + bid * HIDDEN + hid;
+     int dst_iplus1  = (ts + 1) * HIDDEN * BATCH + bid * HIDDEN + hid;
+     dst[i]          = f[i] * x[i];
+     dst[i]          += (1 - f[i]) * dst[dst_iplus1];
+  }
+}
+
+extern "C"
+__global__ void bwd_recurrent_forget_mult_reverse(const float *h, const float *f, const float *x, const float *gh, float *gf, float *gx, float *ghinit, int SEQ, int BATCH, int HIDDEN)
+{
+  /*
+  Note: h is assumed to be one timestep longer than f, x, gf, gx, or gh where h[SEQ] = h_{SEQ}
+  The gradient flows from t=0 (the last step of the reverse recurrence) to t=SEQ-1
+  */
+  int hid = blockIdx.x * blockDim.x + threadIdx.x;
+  int bid = blockIdx.y * blockDim.y + threadIdx.y;
+  if(hid >= HIDDEN || bid >= BATCH)
+     return;
+  //
+  double running_f = 0;
+  for (int ts = 0; ts < SEQ; ts++) {
+     int i           = ts * HIDDEN * BATCH + bid * HIDDEN + hid;
+     int dst_iplus1  = (ts + 1) * HIDDEN * BATCH + bid * HIDDEN + hid;
+     //
+     running_f       += gh[i];
+     // Gradient of X
+     gx[i]           = f[i] * running_f;
+     // Gradient of F
+     gf[i]           = (x[i] - h[dst_iplus1]) * running_f;
+     //
+     running_f       = running_f - f[i] * running_f;
+  }
+  ghinit[bid * HIDDEN + hid] = running_f;
+}
 '''
 
 ###
 
+def _needs_grad(tensors):
+    return torch.is_grad_enabled() and any(t.requires_grad for t in tensors)
+
+
+def _use_numba(tensors):
+    # The compiled loop bypasses autograd so is only used for inference on CPU tensors
+    # NumPy has no bfloat16 and Numba doesn't support float16, so other dtypes use the PyTorch loop
+    if numba is None or _needs_grad(tensors) or any(t.is_cuda for t in tensors): return False
+    return all(t.dtype in (torch.float32, torch.float64) for t in tensors)
+
+
+if numba is not None:
+    @numba.njit(parallel=True, fastmath=True)
+    def _forget_mult_numba(f, x, hidden_init, reverse):
+        # f and x are (seq_len, batch * hidden) and hidden_init is (batch * hidden)
+        # Time is walked in the outer loop so each step reads and writes contiguous rows,
+        # with the independent batch * hidden elements of a step computed in parallel
+        seq_len, n = f.shape
+        result = np.empty_like(f)
+        prev_h = hidden_init
+        for step in range(seq_len):
+            t = seq_len - 1 - step if reverse else step
+            for j in numba.prange(n):
+                result[t, j] = f[t, j] * x[t, j] + (1 - f[t, j]) * prev_h[j]
+            prev_h = result[t]
+        return result
+
+
 class CPUForgetMult(torch.nn.Module):
     def __init__(self):
         super(CPUForgetMult, self).__init__()
 
-    def forward(self, f, x, hidden_init=None):
+    def forward(self, f, x, hidden_init=None, reverse=False):
+        if _use_numba([f, x] if hidden_init is None else [f, x, hidden_init]):
+            return self.forward_numba(f, x, hidden_init, reverse=reverse)
+        ###
         result = []
         ###
         forgets = f.split(1, dim=0)
         prev_h = hidden_init
-        for i, h in enumerate((f * x).split(1, dim=0)):
+        steps = list(enumerate((f * x).split(1, dim=0)))
+        if reverse: steps = reversed(steps)
+        for i, h in steps:
             if prev_h is not None: h = h + (1 - forgets[i]) * prev_h
             # h is (1, batch, hidden) when it needs to be (batch_hidden)
             # Calling squeeze will result in badness if batch size is 1
@@ -88,14 +176,25 @@ class CPUForgetMult(torch.nn.Module):
             result.append(h)
             prev_h = h
         ###
+        if reverse: result.reverse()
         return torch.stack(result)
 
+    def forward_numba(self, f, x, hidden_init=None, reverse=False):
+        seq_size, batch_size, hidden_size = f.size()
+        f_np = f.detach().contiguous().view(seq_size, -1).numpy()
+        x_np = x.detach().contiguous().view(seq_size, -1).to(f.dtype).numpy()
+        if hidden_init is None: h_np = np.zeros(batch_size * hidden_size, dtype=f_np.dtype)
+        else: h_np = hidden_init.detach().contiguous().view(-1).to(f.dtype).numpy()
+        result = _forget_mult_numba(f_np, x_np, h_np, reverse)
+        return torch.from_numpy(result).view(seq_size, batch_size, hidden_size)
+
 
 class GPUForgetMult(torch.autograd.Function):
     configured_gpus = {}
     ptx = None
-    def __init__(self):
+    def __init__(self, reverse=False):
         super(GPUForgetMult, self).__init__()
+        self.reverse = reverse
 
     def compile(self):
         if self.ptx is None:
@@ -106,23 +205,31 @@ class GPUForgetMult(torch.autograd.Function):
             m = function.Module()
             m.load(bytes(self.ptx.encode()))
 
-            self.forget_mult = m.get_function('recurrent_forget_mult')
-            self.bwd_forget_mult = m.get_function('bwd_recurrent_forget_mult')
-
-            Stream = namedtuple('Stream', ['ptr'])
-            self.stream = Stream(ptr=torch.cuda.current_stream().cuda_stream)
+            forget_mult = m.get_function('recurrent_forget_mult')
+            bwd_forget_mult = m.get_function('bwd_recurrent_forget_mult')
+            forget_mult_reverse = m.get_function('recurrent_forget_mult_reverse')
+            bwd_forget_mult_reverse = m.get_function('bwd_recurrent_forget_mult_reverse')
 
-            GPUForgetMult.configured_gpus[torch.cuda.current_device()] = (self.forget_mult, self.bwd_forget_mult, self.stream)
+            GPUForgetMult.configured_gpus[torch.cuda.current_device()] = (forget_mult, bwd_forget_mult, forget_mult_reverse, bwd_forget_mult_reverse)
 
-        self.forget_mult, self.bwd_forget_mult, self.stream = GPUForgetMult.configured_gpus[torch.cuda.current_device()]
+        forget_mult, bwd_forget_mult, forget_mult_reverse, bwd_forget_mult_reverse = GPUForgetMult.configured_gpus[torch.cuda.current_device()]
+        if self.reverse:
+            self.forget_mult, self.bwd_forget_mult = forget_mult_reverse, bwd_forget_mult_reverse
+        else:
+            self.forget_mult, self.bwd_forget_mult = forget_mult, bwd_forget_mult
+        # The stream is looked up per call rather than cached so the kernels follow torch.cuda.stream contexts
+        Stream = namedtuple('Stream', ['ptr'])
+        self.stream = Stream(ptr=torch.cuda.current_stream().cuda_stream)
 
     def forward(self, f, x, hidden_init=None):
         self.compile()
         seq_size, batch_size, hidden_size = f.size()
         result = f.new(seq_size + 1, batch_size, hidden_size)
-        # We only zero the result array (result[0]) if we don't set a hidden initial state
-        # All other values (result[1:]) are overwritten by default
-        if hidden_init is not None: result[0, :, :] = hidden_init
+        # The initial hidden state lives in result[0], or result[-1] when walking backwards in time
+        init = -1 if self.reverse else 0
+        # We only zero the result array (result[init]) if we don't set a hidden initial state
+        # All other values are overwritten by default
+        if hidden_init is not None: result[init, :, :] = hidden_init
         else: result = result.zero_()
         ###
         grid_hidden_size = min(hidden_size, 512)
@@ -130,6 +237,7 @@ class GPUForgetMult(torch.autograd.Function):
         self.forget_mult(grid=grid, block=(grid_hidden_size, 1), args=[result.data_ptr(), f.data_ptr(), x.data_ptr(), seq_size, batch_size, hidden_size], stream=self.stream)
         self.save_for_backward(f, x, hidden_init)
         self.result = result
+        if self.reverse: return result[:-1, :, :]
         return result[1:, :, :]
 
     def backward(self, grad_h):
@@ -162,21 +270,22 @@ class ForgetMult(torch.nn.Module):
         - X (seq_len, batch, input_size): tensor containing the features of the input sequence.
         - F (seq_len, batch, input_size): tensor containing the forget gate values, assumed in range [0, 1].
         - hidden_init (batch, input_size): tensor containing the initial hidden state for the recurrence (h_{t-1}).
-        - use_cuda: If True, use the fast element-wise CUDA kernel for recurrence. If False, uses naive for loop. Default: True.
+        - use_cuda: If True, use the fast element-wise CUDA kernel for recurrence. If False, uses naive for loop (compiled with Numba when installed and no gradients are required). Default: True.
+        - reverse: If True, walks backwards in time computing h_t = f_t * x_t + (1 - f_t) * h_{t+1}. Default: False.
     """
 
     def __init__(self):
         super(ForgetMult, self).__init__()
 
-    def forward(self, f, x, hidden_init=None, use_cuda=True):
+    def forward(self, f, x, hidden_init=None, use_cuda=True, reverse=False):
         # Use CUDA by default unless it's available
         use_cuda = use_cuda and torch.cuda.is_available()
         # Ensure the user is aware when ForgetMult is not GPU version as it's far faster
         if use_cuda: assert f.is_cuda and x.is_cuda, 'GPU ForgetMult with fast element-wise CUDA kernel requested but tensors not on GPU'
         ###
         # Avoiding 'RuntimeError: expected a Variable argument, but got NoneType' when hidden_init is None
-        if hidden_init is None: return GPUForgetMult()(f, x) if use_cuda else CPUForgetMult()(f, x)
-        return GPUForgetMult()(f, x, hidden_init) if use_cuda else CPUForgetMult()(f, x, hidden_init)
+        if hidden_init is None: return GPUForgetMult(reverse)(f, x) if use_cuda else CPUForgetMult()(f, x, reverse=reverse)
+        return GPUForgetMult(reverse)(f, x, hidden_init) if use_cuda else CPUForgetMult()(f, x, hidden_init, reverse=reverse)
 
 ###
 
@@ -242,3 +351,29 @@ if __name__ == '__main__':
     inputs = [forget, a, last_h]
     test = gradcheck(ForgetMult(), inputs, eps=1e-4, atol=1e-2)
     print(test)
+
+    ###
+
+    print()
+    print('Reverse CUDA forget mult vs reverse CPU forget mult')
+    print('=-=-' * 5)
+
+    grads = []
+    results = []
+    for use_cuda in [True, False]:
+        a.grad.data *= 0
+        forget.grad.data *= 0
+        last_h.grad.data *= 0
+        result = ForgetMult()(forget, a, last_h, use_cuda=use_cuda, reverse=True)
+        result.pow(2).sum().backward()
+        results.append(result)
+        grads.append([a.grad.clone(), forget.grad.clone(), last_h.grad.clone()])
+
+    print('Residual error for result =', (results[0] - results[1]).abs().sum().item())
+    for name, grad_cuda, grad_cpu in zip(['X', 'Forget', 'Last H'], *grads):
+        print('Residual error for {} grad ='.format(name), (grad_cuda - grad_cpu).abs().sum().item())
+        assert (grad_cuda - grad_cpu).abs().max().item() < 1e-4, 'Reverse CUDA and CPU ForgetMult gradients differ'
+    assert (results[0] - results[1]).abs().max().item() < 1e-5, 'Reverse CUDA and CPU ForgetMult results differ'
+
+    test = gradcheck(lambda f, x, h: ForgetMult()(f, x, h, reverse=True), inputs, eps=1e-4, atol=1e-2)
+    print(test)
@@ -8,6 +8,37 @@ if __name__ == '__main__':
 else:
     from .forget_mult import ForgetMult
 
+# For window=2 inputs with more elements than this, x_t and x_{t-1} are projected by two GEMMs
+# rather than building the (seq_len, batch, 2 * input) source for a single GEMM
+# The split path reads self.linear.weight directly: it is skipped when linear has forward hooks (e.g. weight_norm),
+# but wrappers replacing linear's forward (e.g. awd-lstm's WeightDrop) are not detected and need a larger threshold
+SPLIT_WINDOW_MIN_SIZE = 2 ** 22
+
+# Side streams used by BiDirQRNNLayer, created lazily per device
+# These are kept off the modules as CUDA streams can't be pickled or deep copied
+_bidir_streams = {}
+
+
+def _bidir_stream_pair(device):
+    if device not in _bidir_streams:
+        _bidir_streams[device] = (torch.cuda.Stream(device=device), torch.cuda.Stream(device=device))
+    return _bidir_streams[device]
+
+
+def split_activate(Y, hidden_size):
+    # Y is (seq_len, batch, len([Z, F, O]) * hidden_size) straight out of the linear layer
+    # This is the same slice-and-activate as chunking Y, not a fused kernel: activating the strided slices of Y
+    # already returns freshly allocated contiguous Z and F as expected by the CUDA kernel
+    Z = torch.tanh(Y[:, :, :hidden_size])
+    F = torch.sigmoid(Y[:, :, hidden_size:2 * hidden_size])
+    # Under autocast (or for a half precision model) the GEMM and activations run in half precision but the recurrence needs FP32
+    if Z.dtype == torch.float16 or Z.dtype == torch.bfloat16:
+        Z = Z.float()
+        F = F.float()
+    # O is left as a strided view (empty if there is no output gate) and activated lazily
+    O = Y[:, :, 2 * hidden_size:]
+    return Z, F, O
+
 
 class QRNNLayer(nn.Module):
     r"""Applies a single layer Quasi-Recurrent Neural Network (QRNN) to an input sequence.
@@ -20,17 +51,19 @@ class QRNNLayer(nn.Module):
         zoneout: Whether to apply zoneout (i.e. failing to update elements in the hidden state) to the hidden state updates. Default: 0.
         output_gate: If True, performs QRNN-fo (applying an output gate to the output). If False, performs QRNN-f. Default: True.
         use_cuda: If True, uses fast custom CUDA kernel. If False, uses naive for loop. Default: True.
+        bias: If False, the layer does not use a bias in the projection computing Z, F and O. Default: True.
 
-    Inputs: X, hidden
+    Inputs: X, hidden, reverse
         - X (seq_len, batch, input_size): tensor containing the features of the input sequence.
         - hidden (batch, hidden_size): tensor containing the initial hidden state for the QRNN.
+        - reverse: If True, runs the QRNN backwards in time over X without flipping it. Default: False.
 
     Outputs: output, h_n
         - output (seq_len, batch, hidden_size): tensor containing the output of the QRNN for each timestep.
-        - h_n (batch, hidden_size): tensor containing the hidden state for t=seq_len
+        - h_n (batch, hidden_size): tensor containing the hidden state for t=seq_len (t=0 if reverse)
     """
 
-    def __init__(self, input_size, hidden_size=None, save_prev_x=False, zoneout=0, window=1, output_gate=True, use_cuda=True):
+    def __init__(self, input_size, hidden_size=None, save_prev_x=False, zoneout=0, window=1, output_gate=True, use_cuda=True, bias=True):
         super(QRNNLayer, self).__init__()
 
         assert window in [1, 2], "This QRNN implementation currently only handles convolutional window of size 1 or size 2"
@@ -42,92 +75,137 @@ class QRNNLayer(nn.Module):
         self.prevX = None
         self.output_gate = output_gate
         self.use_cuda = use_cuda
+        self.bias = bias
 
         # One large matmul with concat is faster than N small matmuls and no concat
-        self.linear = nn.Linear(self.window * self.input_size, 3 * self.hidden_size if self.output_gate else 2 * self.hidden_size)
+        self.linear = nn.Linear(self.window * self.input_size, 3 * self.hidden_size if self.output_gate else 2 * self.hidden_size, bias=bias)
+
+        # Zeroed stand-in for x_{-1}, expanded over the batch rather than allocated and zeroed every forward
+        self.register_buffer('_zero_prev', torch.zeros(1, 1, self.input_size), persistent=False)
+
+    # Public views of the Z, F and O gate weights, sharing storage with self.linear.weight
+    # These are for inspection or initialization only, the forward pass uses self.linear.weight as a whole
+    @property
+    def W_z(self):
+        return self.linear.weight[:self.hidden_size]
+
+    @property
+    def W_f(self):
+        return self.linear.weight[self.hidden_size:2 * self.hidden_size]
+
+    @property
+    def W_o(self):
+        return self.linear.weight[2 * self.hidden_size:] if self.output_gate else None
 
     def reset(self):
         # If you are saving the previous value of x, you should call this when starting with a new state
         self.prevX = None
 
-    def forward(self, X, hidden=None):
+    def _linear_has_hooks(self):
+        return bool(self.linear._forward_pre_hooks or self.linear._forward_hooks)
+
+    def _split_window_linear(self, X, reverse=False):
+        # Computes [x_t, x_{t-1}] W^T as x_t W_0^T + x_{t-1} W_1^T without materializing the 2 * input source
+        # x_{t-1} is X shifted by one timestep, so its GEMM is accumulated in place into the overlapping rows of Y
+        seq_len, batch_size = X.size(0), X.size(1)
+        weight = self.linear.weight
+        W0, W1 = weight[:, :self.input_size], weight[:, self.input_size:].t()
+        Y = torch.nn.functional.linear(X.reshape(seq_len * batch_size, self.input_size), W0, self.linear.bias)
+        # Under autocast Y comes out in half precision and in-place ops aren't cast for us
+        W1 = W1.to(Y.dtype)
+        if reverse:
+            Y[:-batch_size].addmm_(X[1:].reshape(-1, self.input_size).to(Y.dtype), W1)
+            prev_rows = Y[-batch_size:]
+        else:
+            Y[batch_size:].addmm_(X[:-1].reshape(-1, self.input_size).to(Y.dtype), W1)
+            prev_rows = Y[:batch_size]
+        # A zeroed out x_{-1} contributes nothing so only a saved prevX needs projecting
+        if self.prevX is not None:
+            prev_rows.addmm_(self.prevX.reshape(batch_size, self.input_size).to(Y.dtype), W1)
+        return Y
 
-        try:
-            seq_len, batch_size, _ = X.size()
-        except:
-            input = X
-            X, batch_sizes, sorted_indices, unsorted_indices = input
-            max_batch_size = batch_sizes[0]
-            max_batch_size = int(max_batch_size)
-            print(X.size())
-            seq_len, batch_size = X.size()
-            
+    def forward(self, X, hidden=None, reverse=False):
 
-            
-        
+        if isinstance(X, PackedSequence):
+            X, batch_sizes, sorted_indices, unsorted_indices = X
+            seq_len, batch_size = X.size()
+        else:
+            seq_len, batch_size, _ = X.size()
 
         source = None
         if self.window == 1:
             source = X
+        elif self.window == 2 and seq_len * batch_size * self.input_size > SPLIT_WINDOW_MIN_SIZE and not self._linear_has_hooks():
+            # For large inputs building the doubled source costs more memory traffic than a second GEMM
+            Y = self._split_window_linear(X, reverse=reverse)
         elif self.window == 2:
-            # Construct the x_{t-1} tensor with optional x_{-1}, otherwise a zeroed out value for x_{-1}
-            Xm1 = []
-            Xm1.append(self.prevX if self.prevX is not None else X[:1, :, :] * 0)
-            # Note: in case of len(X) == 1, X[:-1, :, :] results in slicing of empty tensor == bad
-            if len(X) > 1:
-                Xm1.append(X[:-1, :, :])
-            Xm1 = torch.cat(Xm1, 0)
-            # Convert two (seq_len, batch_size, hidden) tensors to (seq_len, batch_size, 2 * hidden)
-            source = torch.cat([X, Xm1], 2)
+            # Build the (seq_len, batch_size, 2 * hidden) tensor of [x_t, x_{t-1}] in a single allocation,
+            # writing each half in place rather than concatenating x_{t-1} and then concatenating again
+            # Note: an unfold over time would yield [x_{t-1}, x_t] which doesn't match the weight layout
+            source = X.new_empty(seq_len, batch_size, 2 * self.input_size)
+            source[:, :, :self.input_size] = X
+            # Use the optional x_{-1}, otherwise a zeroed out value for x_{-1}
+            # When running in reverse the previous token is x_{t+1} instead
+            prev = self.prevX if self.prevX is not None else self._zero_prev.expand(1, batch_size, self.input_size)
+            if reverse:
+                source[:-1, :, self.input_size:] = X[1:, :, :]
+                source[-1:, :, self.input_size:] = prev
+            else:
+                source[1:, :, self.input_size:] = X[:-1, :, :]
+                source[:1, :, self.input_size:] = prev
 
         # Matrix multiplication for the three outputs: Z, F, O
-        Y = self.linear(source)
+        # Flattening to 2D ensures a single addmm (or mm without bias) rather than the slower batched matmul path for 3D inputs
+        # Calling self.linear keeps any hooks or wrappers on it (e.g. weight_norm) working
+        if source is not None:
+            Y = self.linear(source.reshape(seq_len * batch_size, self.window * self.input_size))
         # Convert the tensor back to (batch, seq_len, len([Z, F, O]) * hidden_size)
         if self.output_gate:
             Y = Y.view(seq_len, batch_size, 3 * self.hidden_size)
-            Z, F, O = Y.chunk(3, dim=2)
         else:
             Y = Y.view(seq_len, batch_size, 2 * self.hidden_size)
-            Z, F = Y.chunk(2, dim=2)
         ###
-        Z = torch.nn.functional.tanh(Z)
-        F = torch.nn.functional.sigmoid(F)
+        Z, F, O = split_activate(Y, self.hidden_size)
 
         # If zoneout is specified, we perform dropout on the forget gates in F
         # If an element of F is zero, that means the corresponding neuron keeps the old value
         if self.zoneout:
             if self.training:
-                mask = Variable(F.data.new(*F.size()).bernoulli_(1 - self.zoneout), requires_grad=False)
-                F = F * mask
-            else:
-                F *= 1 - self.zoneout
+                # Dropout applies a boolean mask in one fused kernel but scales kept values by 1 / (1 - p),
+                # which the scaling below cancels to match zoneout
+                F = torch.nn.functional.dropout(F, p=self.zoneout, training=True)
+            F.mul_(1 - self.zoneout)
 
-        # Ensure the memory is laid out as expected for the CUDA kernel
-        # This is a null op if the tensor is already contiguous
-        Z = Z.contiguous()
-        F = F.contiguous()
+        # No explicit contiguous() is needed for the CUDA kernel as split_activate (and zoneout) write fresh contiguous Z and F
         # The O gate doesn't need to be contiguous as it isn't used in the CUDA kernel
 
         # Forget Mult
         # For testing QRNN without ForgetMult CUDA kernel, C = Z * F may be useful
-        C = ForgetMult()(F, Z, hidden, use_cuda=self.use_cuda)
+        # Autocast is disabled so that the recurrence stays in FP32
+        with torch.autocast(device_type=F.device.type, enabled=False):
+            C = ForgetMult()(F, Z, hidden, use_cuda=self.use_cuda, reverse=reverse)
 
         # Apply (potentially optional) output gate
         if self.output_gate:
-            H = torch.nn.functional.sigmoid(O) * C
+            H = torch.sigmoid(O) * C
         else:
             H = C
 
         # In an optimal world we may want to backprop to x_{t-1} but ...
         if self.window > 1 and self.save_prev_x:
-            self.prevX = Variable(X[-1:, :, :].data, requires_grad=False)
+            # A detached view sharing X's storage, so mutating X in place between calls also changes prevX
+            self.prevX = (X[:1, :, :] if reverse else X[-1:, :, :]).detach()
 
-        return H, C[-1:, :, :]
+        # The recurrence always runs in FP32 so return to the input's precision, a no-op unless the model itself is FP16 / BF16
+        H = H.to(X.dtype)
+        if reverse:
+            return H, C[0].to(X.dtype)
+        return H, C[-1].to(X.dtype)
 
 class BiDirQRNNLayer(nn.Module):
     # Credits: @danFromTelAviv in issues: https://github.com/salesforce/pytorch-qrnn/issues/16
     def __init__(self, input_size, hidden_size=None, save_prev_x=False, zoneout=0, window=1, output_gate=True,
-                 use_cuda=True):
+                 use_cuda=True, bias=True):
         super(BiDirQRNNLayer, self).__init__()
 
         assert window in [1,
@@ -140,20 +218,40 @@ class BiDirQRNNLayer(nn.Module):
         self.prevX = None
         self.output_gate = output_gate
         self.use_cuda = use_cuda
+        self.bias = bias
 
         self.forward_qrnn = QRNNLayer(input_size, hidden_size=hidden_size, save_prev_x=save_prev_x, zoneout=zoneout, window=window,
-                                      output_gate=output_gate, use_cuda=use_cuda)
+                                      output_gate=output_gate, use_cuda=use_cuda, bias=bias)
         self.backward_qrnn = QRNNLayer(input_size, hidden_size=hidden_size, save_prev_x=save_prev_x, zoneout=zoneout, window=window,
-                                       output_gate=output_gate, use_cuda=use_cuda)
+                                       output_gate=output_gate, use_cuda=use_cuda, bias=bias)
+
 
     def forward(self, X, hidden=None):
-        if not hidden is None:
-            fwd, h_fwd = self.forward_qrnn(X, hidden=hidden)
-            bwd, h_bwd = self.backward_qrnn(torch.flip(X, [0]), hidden=hidden)
+        # The backward direction walks X in reverse directly, so no flipped copies of the input or output are needed
+        if X.is_cuda:
+            # The two directions are independent so each gets its own stream, allowing their GEMMs and
+            # ForgetMult kernels to overlap when a single direction doesn't saturate the GPU (not yet benchmarked)
+            current = torch.cuda.current_stream(X.device)
+            s_fwd, s_bwd = _bidir_stream_pair(X.device)
+            s_fwd.wait_stream(current)
+            s_bwd.wait_stream(current)
+            with torch.cuda.stream(s_fwd):
+                fwd, h_fwd = self.forward_qrnn(X, hidden=hidden)
+            with torch.cuda.stream(s_bwd):
+                bwd, h_bwd = self.backward_qrnn(X, hidden=hidden, reverse=True)
+            current.wait_stream(s_fwd)
+            current.wait_stream(s_bwd)
+            # Let the caching allocator know which streams use which tensors before they are freed
+            X.record_stream(s_fwd)
+            X.record_stream(s_bwd)
+            if hidden is not None:
+                hidden.record_stream(s_fwd)
+                hidden.record_stream(s_bwd)
+            for t in (fwd, h_fwd, bwd, h_bwd):
+                t.record_stream(current)
         else:
-            fwd, h_fwd = self.forward_qrnn(X)
-            bwd, h_bwd = self.backward_qrnn(torch.flip(X, [0]))
-        bwd = torch.flip(bwd, [0])
+            fwd, h_fwd = self.forward_qrnn(X, hidden=hidden)
+            bwd, h_bwd = self.backward_qrnn(X, hidden=hidden, reverse=True)
         return torch.cat([fwd, bwd], dim=-1), torch.cat([h_fwd, h_bwd], dim=-1)
 
 class QRNN(torch.nn.Module):
@@ -169,6 +267,7 @@ class QRNN(torch.nn.Module):
         zoneout: Whether to apply zoneout (i.e. failing to update elements in the hidden state) to the hidden state updates. Default: 0.
         output_gate: If True, performs QRNN-fo (applying an output gate to the output). If False, performs QRNN-f. Default: True.
         use_cuda: If True, uses fast custom CUDA kernel. If False, uses naive for loop. Default: True.
+        bias: If False, the layer does not use a bias in the projection computing Z, F and O. Default: True.
 
     Inputs: X, hidden
         - X (seq_len, batch, input_size): tensor containing the features of the input sequence.
@@ -183,17 +282,16 @@ class QRNN(torch.nn.Module):
                  num_layers=1, bias=True, batch_first=False,
                  dropout=0, bidirectional=False, layers=None, **kwargs):
         assert batch_first == False, 'Batch first mode is not yet supported'
-        assert bias == True, 'Removing underlying bias is not yet supported'
 
         super(QRNN, self).__init__()
 
         if bidirectional:
             self.layers = torch.nn.ModuleList(
-                layers if layers else [BiDirQRNNLayer(input_size if l == 0 else hidden_size*2, hidden_size, **kwargs) for l in
+                layers if layers else [BiDirQRNNLayer(input_size if l == 0 else hidden_size*2, hidden_size, bias=bias, **kwargs) for l in
                                        range(num_layers)])
         else:
             self.layers = torch.nn.ModuleList(
-                layers if layers else [QRNNLayer(input_size if l == 0 else hidden_size, hidden_size, **kwargs) for l in
+                layers if layers else [QRNNLayer(input_size if l == 0 else hidden_size, hidden_size, bias=bias, **kwargs) for l in
                                        range(num_layers)])
 
 
@@ -219,7 +317,7 @@ class QRNN(torch.nn.Module):
             if self.dropout != 0 and i < len(self.layers) - 1:
                 input = torch.nn.functional.dropout(input, p=self.dropout, training=self.training, inplace=False)
 
-        next_hidden = torch.cat(next_hidden, 0).view(self.num_layers, *next_hidden[0].size()[-2:])
+        next_hidden = torch.stack(next_hidden, 0)
 
         return input, next_hidden
 
@@ -240,7 +338,6 @@ if __name__ == '__main__':
     seq_len, batch_size, hidden_size = 35, 8, 32
     size = (seq_len, batch_size, hidden_size)
     X = Variable(torch.rand(size), requires_grad=True).cuda()
-    print(X.size())
 
     qrnn = QRNNLayer(hidden_size, hidden_size)
     qrnn.cuda()
@@ -257,3 +354,26 @@ if __name__ == '__main__':
     inputs = [X,]
     test = gradcheck(QRNNLayer(hidden_size, hidden_size).cuda(), inputs)
     print(test)
+
+    ###
+
+    # Check the two GEMM window=2 path against the single GEMM over [x_t, x_{t-1}], forcing it with a zero threshold
+    default_split_size = SPLIT_WINDOW_MIN_SIZE
+    qrnn = QRNNLayer(hidden_size, hidden_size, window=2, save_prev_x=True, use_cuda=False)
+    X = torch.rand(size, requires_grad=True)
+    for reverse in [False, True]:
+        results = []
+        for SPLIT_WINDOW_MIN_SIZE in [float('inf'), 0]:
+            qrnn.reset()
+            qrnn.zero_grad()
+            X.grad = None
+            # The first call covers seq_len == 1 and leaves a saved prevX for the second
+            qrnn(X[:1], reverse=reverse)
+            Y, h = qrnn(X, reverse=reverse)
+            (Y.pow(2).sum() + h.sum()).backward()
+            results.append([Y, h, X.grad, qrnn.linear.weight.grad, qrnn.linear.bias.grad])
+        for dense, split in zip(*results):
+            diff = (dense - split).abs().max().item()
+            assert diff < 1e-5, 'Split and dense window=2 QRNN layers return different results (reverse={})'.format(reverse)
+    SPLIT_WINDOW_MIN_SIZE = default_split_size
+    print('Split and dense window=2 QRNN layers match')